@@ -1,23 +1,73 @@
 #!/usr/bin/env python3
 
 import logging
-DEBUG = False
-logging.basicConfig(
-        filename='/tmp/protoprint.log', encoding='utf-8',
-        format='[%(asctime)s] %(levelname)s %(funcName)s - %(message)s',
-        level=logging.DEBUG if DEBUG else logging.INFO)
-
 import sys
 import os
-import json
-from urllib import request, error
-import subprocess
-import tempfile
+import signal
+
+DEBUG = False
 
 # The API endpoint to notify about a new print job.
 # This server should return a 200 OK status to allow the print job.
 API_ENDPOINT = "https://api.spaceport.dns.t0.vc/protocoin/cups_printer_report/"
 
+# Device URIs for this backend are the real printer URI behind this prefix.
+_URI_PREFIX = "printmanager:"
+_URI_PREFIX_LEN = len(_URI_PREFIX)
+
+# Gateway errors from the API are temporary, so retry the job on these.
+# 504 is left out: the API may still have recorded the job behind it.
+_RETRY_STATUSES = (502, 503)
+
+# Connection pool for the API, created on first use.
+_POOL = None
+
+
+def setup_logging():
+    """Logs to a file, since CUPS captures our stderr."""
+    logging.basicConfig(
+            filename='/tmp/protoprint.log', encoding='utf-8',
+            format='[%(asctime)s] %(levelname)s %(funcName)s - %(message)s',
+            level=logging.DEBUG if DEBUG else logging.INFO)
+
+
+def get_pool():
+    """
+    Returns the urllib3 pool used for the API request, going through the
+    same proxy from the environment that urllib would use.
+    Returns None if urllib3 is missing or unusable, so urllib is used instead.
+    """
+    global _POOL
+    if _POOL is None:
+        try:
+            import urllib3
+        except ImportError:
+            return None
+
+        from urllib import request, parse
+        url = parse.urlsplit(API_ENDPOINT)
+        proxy = None
+        if not request.proxy_bypass(url.hostname):
+            proxy = request.getproxies().get(url.scheme)
+
+        try:
+            options = dict(
+                    timeout=urllib3.Timeout(connect=3.0, read=10.0),
+                    # Only re-send the report when the API cannot have recorded it:
+                    # connection failures and 503. Never after a read error.
+                    retries=urllib3.Retry(
+                            total=2, read=0, backoff_factor=0.25,
+                            status_forcelist=(503,), allowed_methods={'POST'}))
+            if proxy:
+                _POOL = urllib3.ProxyManager(proxy, **options)
+            else:
+                _POOL = urllib3.PoolManager(**options)
+        except Exception as e:
+            # e.g. urllib3 older than 1.26 has no allowed_methods.
+            logging.warning(f"Could not set up urllib3, falling back to urllib: {e}")
+            return None
+    return _POOL
+
 
 def approve_job():
     """Instructs CUPS that the job is successful."""
@@ -37,6 +87,81 @@ def cancel_job():
     sys.exit(4)
 
 
+def timeout_job(signum, frame):
+    """Retries the job if we take too long to release it."""
+    logging.error('Timed out before releasing the job.')
+    retry_job()
+
+
+def notify_api(payload):
+    """
+    POSTs the job details to API_ENDPOINT.
+    Returns if the API approves the job, otherwise cancels or retries it.
+    """
+    import json
+    data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+
+    pool = get_pool()
+    if pool is not None:
+        import urllib3  # already loaded by get_pool()
+        try:
+            resp = pool.request('POST', API_ENDPOINT, body=data, headers=headers)
+        except urllib3.exceptions.HTTPError as e:
+            # This handles network errors (DNS, timeout, connection refused, retries exhausted).
+            logging.error(f"API request failed: {e}")
+            retry_job()
+
+        if resp.status in _RETRY_STATUSES:
+            logging.error(f"API request failed with status {resp.status}.")
+            retry_job()
+
+        if resp.status >= 400:
+            response_text = resp.data.decode('utf-8', 'ignore')
+            logging.error(f"API call failed with status {resp.status}. Job will not be printed.")
+            logging.error(f"Response: {response_text}")
+            cancel_job()
+    else:
+        from urllib import request, error
+        try:
+            req = request.Request(API_ENDPOINT, data=data, headers=headers)
+            with request.urlopen(req, timeout=10):
+                # If we get here, urlopen was successful and didn't raise HTTPError.
+                # This implies a 2xx or 3xx response (which is followed).
+                pass
+        except error.HTTPError as e:
+            # This handles 4xx and 5xx responses.
+            if e.code in _RETRY_STATUSES:
+                logging.error(f"API request failed with status {e.code}.")
+                retry_job()
+
+            response_text = e.read().decode('utf-8', 'ignore')
+            logging.error(f"API call failed with status {e.code}. Job will not be printed.")
+            logging.error(f"Response: {response_text}")
+            cancel_job()
+        except OSError as e:
+            # This handles other network errors (DNS, timeout, connection refused/reset).
+            logging.error(f"API request failed: {e}")
+            retry_job()
+
+
+def exec_real_backend(backend_args):
+    """
+    Replaces this process with the real backend to perform the printing.
+    CUPS receives the real backend's exit status directly.
+    """
+    # Signal state survives the exec, so cancel the alarm and restore the
+    # SIGPIPE/SIGXFSZ defaults Python ignores, as subprocess would.
+    signal.alarm(0)
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    signal.signal(signal.SIGXFSZ, signal.SIG_DFL)
+    try:
+        os.execv(backend_args[0], backend_args)
+    except OSError as e:
+        logging.error(f"Could not execute real backend {backend_args[0]}: {e}")
+        retry_job()
+
+
 def main():
     """
     CUPS backend script to control print job release via an API call.
@@ -46,6 +171,13 @@ def main():
     if len(sys.argv) < 6:
         approve_job()
 
+    # Only set up what a print job needs once we know we have one.
+    setup_logging()
+
+    # Don't let a stalled API call hold up the CUPS queue.
+    signal.signal(signal.SIGALRM, timeout_job)
+    signal.alarm(60)
+
     job_id = sys.argv[1]
     user = sys.argv[2]
     title = sys.argv[3]
@@ -66,11 +198,11 @@ def main():
     # printmanager:/<real_backend_uri>
     # e.g., printmanager:socket://192.168.1.123:9100
     device_uri = os.environ.get("DEVICE_URI")
-    if not device_uri or not device_uri.startswith("printmanager:"):
+    if not device_uri or not device_uri.startswith(_URI_PREFIX):
         logging.error("Invalid DEVICE_URI. Expected 'printmanager:/<real_uri>'.")
         retry_job()
 
-    real_printer_uri = device_uri[len("printmanager:"):]
+    real_printer_uri = device_uri[_URI_PREFIX_LEN:]
     if not real_printer_uri:
         logging.error("Real printer URI is missing from DEVICE_URI.")
         retry_job()
@@ -89,64 +221,39 @@ def main():
     else:
         logging.info(f"Processing job {job_id} for user {user}. Notifying API.")
 
-        try:
-            data = json.dumps(payload).encode('utf-8')
-            req = request.Request(API_ENDPOINT, data=data, headers={'Content-Type': 'application/json'})
-            with request.urlopen(req, timeout=30):
-                # If we get here, urlopen was successful and didn't raise HTTPError.
-                # This implies a 2xx or 3xx response (which is followed).
-                logging.info(f"API approval received for job {job_id}. Releasing to printer.")
-        except error.HTTPError as e:
-            # This handles 4xx and 5xx responses.
-            response_text = e.read().decode('utf-8', 'ignore')
-            logging.error(f"API call failed with status {e.code}. Job will not be printed.")
-            logging.error(f"Response: {response_text}")
-            cancel_job()
-        except error.URLError as e:
-            # This handles other network errors (DNS, timeout, connection refused).
-            logging.error(f"API request failed: {e}")
-            retry_job()
+        notify_api(payload)
+        logging.info(f"API approval received for job {job_id}. Releasing to printer.")
 
     # API call was successful, now release the job to the real printer.
-    try:
-        scheme = real_printer_uri.split(':', 1)[0]
-    except IndexError:
+    colon = real_printer_uri.find(':')
+    if colon <= 0:
         logging.error(f"Could not determine scheme from real printer URI: {real_printer_uri}")
         retry_job()
+    scheme = real_printer_uri[:colon]
 
     backend_path = f"/usr/lib/cups/backend/{scheme}"
-    if not os.path.exists(backend_path) or not os.access(backend_path, os.X_OK):
-        logging.error(f"CUPS backend for scheme '{scheme}' not found or not executable at {backend_path}.")
+    try:
+        backend_mode = os.stat(backend_path).st_mode
+    except OSError as e:
+        logging.error(f"CUPS backend for scheme '{scheme}' not usable at {backend_path}: {e}")
+        retry_job()
+
+    if not backend_mode & 0o111:
+        logging.error(f"CUPS backend for scheme '{scheme}' not executable at {backend_path}.")
         retry_job()
 
     # The print job data is on stdin if no file is given.
-    # We must pass it to the real backend.
-    # Using a temporary file ensures the data is read before we execute the next process.
-    temp_job_file = None
-    if not job_file:
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            tmp.write(sys.stdin.buffer.read())
-            job_file = tmp.name
-            temp_job_file = job_file
+    # The real backend inherits our stdin when it replaces this process,
+    # so it streams the job itself; just omit the file argument.
 
     # Set up environment and arguments for the real backend
-    backend_env = os.environ.copy()
-    backend_env["DEVICE_URI"] = real_printer_uri
-    backend_args = [backend_path, job_id, user, title, copies, options, job_file]
+    os.environ["DEVICE_URI"] = real_printer_uri
+    backend_args = [backend_path, job_id, user, title, copies, options]
+    if job_file:
+        backend_args.append(job_file)
 
-    try:
-        # Execute the real backend to perform the printing
-        result = subprocess.run(backend_args, env=backend_env, check=False)
-        if result.returncode == 0:
-            logging.info(f"Job {job_id} successfully sent to printer.")
-            approve_job()
-        else:
-            logging.error(f"Real backend '{scheme}' failed with exit code {result.returncode}.")
-            retry_job()
-    finally:
-        # Clean up the temporary file if we created one
-        if temp_job_file:
-            os.unlink(temp_job_file)
+    logging.info(f"Handing job {job_id} to real backend '{scheme}'.")
+    exec_real_backend(backend_args)
 
 if __name__ == "__main__":
     main()